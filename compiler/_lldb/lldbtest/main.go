@@ -454,6 +454,42 @@ func ScopeSwitch(i int) {
 	println("a:", a)
 }
 
+func ScopeShadow(cond bool) {
+	x := 1
+	if cond {
+		x := 2
+		// Expected:
+		//   all variables: x cond
+		//   x: 2
+		println("x:", x)
+	}
+	// Expected:
+	//   all variables: x cond
+	//   x: 1
+	println("x:", x)
+}
+
+func FuncWithScalarSlices() {
+	bs := []bool{true, false, true}
+	i16s := []int16{-1, 2, -300}
+	u32s := []uint32{4294967295, 0, 7}
+	u64s := []uint64{18446744073709551615, 1}
+	u8s := []uint8{'a', 'b', 'c'}
+	f64s := []float64{1.5, -2.25, 12}
+	many := []int{1, 2, 3, 4, 5, 6}
+	// Expected:
+	//   all variables: bs i16s u32s u64s u8s f64s many
+	//   bs: []bool{true, false, true}
+	//   i16s: []int16{-1, 2, -300}
+	//   u32s: []uint32{4294967295, 0, 7}
+	//   u64s: []uint64{18446744073709551615, 1}
+	//   u8s: []uint8{'a', 'b', 'c'}
+	//   f64s: []float64{1.5, -2.25, 12}
+	//   many[0]: 1
+	//   many[5]: 6
+	println(len(bs), len(i16s), len(u32s), len(u64s), len(u8s), len(f64s), len(many))
+}
+
 func main() {
 	FuncStructParams(TinyStruct{I: 1}, SmallStruct{I: 2, J: 3}, MidStruct{I: 4, J: 5, K: 6}, BigStruct{I: 7, J: 8, K: 9, L: 10, M: 11, N: 12, O: 13, P: 14, Q: 15, R: 16})
 	FuncStructPtrParams(&TinyStruct{I: 1}, &SmallStruct{I: 2, J: 3}, &MidStruct{I: 4, J: 5, K: 6}, &BigStruct{I: 7, J: 8, K: 9, L: 10, M: 11, N: 12, O: 13, P: 14, Q: 15, R: 16})
@@ -547,6 +583,8 @@ func main() {
 	ScopeSwitch(1)
 	ScopeSwitch(2)
 	ScopeSwitch(3)
+	ScopeShadow(true)
+	FuncWithScalarSlices()
 	println(globalStructPtr)
 	println(&globalStruct)
 	s.i8 = 0x12
@@ -1,12 +1,73 @@
 # pylint: disable=missing-module-docstring,missing-class-docstring,missing-function-docstring
 
-from typing import List, Optional, Dict, Any, Tuple
+from dataclasses import dataclass, field
+from typing import List, Optional, Dict, Any, Tuple, Union
+import functools
 import re
+import struct
+import sys
 import lldb
 
 
+# Integer basic types decoded in bulk -> signedness. Character types (char,
+# wchar_t, char16_t, char32_t...) are left out since LLDB renders them as
+# character literals.
+_INT_BASIC_TYPES: Dict[int, bool] = {
+    lldb.eBasicTypeShort: True,
+    lldb.eBasicTypeUnsignedShort: False,
+    lldb.eBasicTypeInt: True,
+    lldb.eBasicTypeUnsignedInt: False,
+    lldb.eBasicTypeLong: True,
+    lldb.eBasicTypeUnsignedLong: False,
+    lldb.eBasicTypeLongLong: True,
+    lldb.eBasicTypeUnsignedLongLong: False,
+}
+
+# struct format characters for integer slice elements, keyed by (byte size, signed)
+_INT_FORMATS: Dict[Tuple[int, bool], str] = {
+    (2, True): 'h',
+    (2, False): 'H',
+    (4, True): 'i',
+    (4, False): 'I',
+    (8, True): 'q',
+    (8, False): 'Q',
+}
+
+
+@dataclass
+class TypeCache:
+    # element type name -> struct format character, or None if not decodable in bulk
+    scalar_formats: Dict[str, Optional[str]] = field(default_factory=dict)
+    # (type name, byte size) -> (resolved type name, type class, is pointer, is array, declared type name)
+    type_infos: Dict[Tuple[str, int], Tuple[str, int, bool, bool, str]] = field(
+        default_factory=dict)
+    # array type name -> displayed element type name
+    elem_type_names: Dict[str, str] = field(default_factory=dict)
+
+
+# process unique ID -> type metadata of that process, only the latest process
+# is kept so a rebuilt or different executable never sees stale entries
+_type_caches: Dict[int, TypeCache] = {}
+
+# Largest slice backing array decoded from a single read, guards against uninitialized headers
+_MAX_BULK_READ = 1 << 20
+
+# Longest string read from target memory, guards against uninitialized headers
+_MAX_STRING_LEN = 1 << 20
+
+# Reused for memory reads, cleared before each use
+_read_error = lldb.SBError()
+
+# A pending output token: literal text, or a (value, include_type, indent) still to be formatted
+_Item = Union[str, Tuple[lldb.SBValue, bool, int]]
+
+
 def log(*args: Any, **kwargs: Any) -> None:
-    print(*args, **kwargs, flush=True)
+    print(*args, **kwargs)
+
+
+def flush() -> None:
+    sys.stdout.flush()
 
 
 def __lldb_init_module(debugger: lldb.SBDebugger, _: Dict[str, Any]) -> None:
@@ -30,7 +91,7 @@ def get_indexed_value(value: lldb.SBValue, index: int) -> Optional[lldb.SBValue]
         data_ptr = value.GetChildMemberWithName('data')
         element_type = data_ptr.GetType().GetPointeeType()
         element_size = element_type.GetByteSize()
-        ptr_value = int(data_ptr.GetValue(), 16)
+        ptr_value = data_ptr.GetValueAsUnsigned()
         element_address = ptr_value + index * element_size
         target = value.GetTarget()
         return target.CreateValueFromAddress(
@@ -41,7 +102,18 @@ def get_indexed_value(value: lldb.SBValue, index: int) -> Optional[lldb.SBValue]
         return None
 
 
-def evaluate_expression(frame: lldb.SBFrame, expression: str) -> Optional[lldb.SBValue]:
+def read_var(frame: lldb.SBFrame, name: str, variables: Optional[Dict[str, lldb.SBValue]] = None) -> lldb.SBValue:
+    if variables is not None:
+        var = variables.get(name)
+        if var is not None:
+            return var
+    # Always resolve variables with `frame variable` semantics: never go through
+    # `expression`/`po`, and skip dynamic type resolution, both of which may run
+    # code in the target.
+    return frame.FindVariable(name, lldb.eNoDynamicValues)
+
+
+def evaluate_expression(frame: lldb.SBFrame, expression: str, variables: Optional[Dict[str, lldb.SBValue]] = None) -> Optional[lldb.SBValue]:
     parts = re.findall(r'\*|\w+|\(|\)|\[.*?\]|\.', expression)
 
     def evaluate_part(i: int) -> Tuple[Optional[lldb.SBValue], int]:
@@ -71,7 +143,7 @@ def evaluate_expression(frame: lldb.SBFrame, expression: str) -> Optional[lldb.S
                 return value, i + 1
             elif part == '.':
                 if value is None:
-                    value = frame.FindVariable(parts[i+1])
+                    value = read_var(frame, parts[i+1], variables)
                 else:
                     value = value.GetChildMemberWithName(parts[i+1])
                 i += 2
@@ -81,7 +153,7 @@ def evaluate_expression(frame: lldb.SBFrame, expression: str) -> Optional[lldb.S
                 i += 1
             else:
                 if value is None:
-                    value = frame.FindVariable(part)
+                    value = read_var(frame, part, variables)
                 else:
                     value = value.GetChildMemberWithName(part)
                 i += 1
@@ -126,17 +198,108 @@ def print_all_variables(debugger: lldb.SBDebugger, _command: str, result: lldb.S
 
 
 def is_pointer(frame: lldb.SBFrame, var_name: str) -> bool:
-    var = frame.FindVariable(var_name)
+    var = read_var(frame, var_name)
     return var.IsValid() and var.GetType().IsPointerType()
 
 
 def format_value(var: lldb.SBValue, debugger: lldb.SBDebugger, include_type: bool = True, indent: int = 0) -> str:
-    if not var.IsValid():
-        return "<variable not available>"
+    out: List[str] = []
+    format_value_into(var, debugger, out, include_type, indent)
+    return "".join(out)
+
+
+def format_value_into(var: lldb.SBValue, debugger: lldb.SBDebugger, out: List[str], include_type: bool = True, indent: int = 0) -> None:
+    # Nested values are walked with an explicit stack instead of recursion,
+    # all text is appended to out and joined once by the caller.
+    cache = type_cache(var)
+    stack: List[_Item] = [(var, include_type, indent)]
+    while stack:
+        item = stack.pop()
+        if isinstance(item, str):
+            out.append(item)
+            continue
+
+        var, include_type, indent = item
+        # Most values are scalars, answer those before any type introspection
+        value = var.GetValue()
+        if value is not None and not var.MightHaveChildren():
+            out.append(value)
+            continue
+
+        if not var.IsValid():
+            out.append("<variable not available>")
+            continue
+
+        type_name, type_class, is_ptr, is_array, original_type_name = type_info(
+            cache, var.GetType())
+
+        if is_ptr:
+            out.append(format_pointer(
+                var, debugger, indent, original_type_name))
+            continue
+
+        if type_name.startswith('[]'):  # Slice
+            expanded = expand_slice(var, debugger, indent, cache)
+        elif is_array:
+            expanded = expand_array(var, indent, cache)
+        elif type_name == 'string':  # String
+            out.append(format_string(var))
+            continue
+        elif type_class in [lldb.eTypeClassStruct, lldb.eTypeClassClass]:
+            expanded = expand_struct(
+                var, include_type, indent, original_type_name)
+        else:
+            summary = var.GetSummary()
+            if value is not None:
+                out.append(value)
+            elif summary is not None:
+                out.append(summary)
+            else:
+                out.append("<variable not available>")
+            continue
+
+        if expanded is None:
+            out.append("<variable not available>")
+            continue
+        header, elements = expanded
+        out.append(header)
+        push_elements(stack, elements, indent)
+
+
+def push_elements(stack: List[_Item], elements: List[List[_Item]], indent: int) -> None:
+    tokens: List[_Item] = []
+    if len(elements) > 5:  # wrap line if too many elements
+        next_indent_str = '  ' * (indent + 1)
+        for i, element in enumerate(elements):
+            tokens.append((",\n" if i else "\n") + next_indent_str)
+            tokens.extend(element)
+        tokens.append(f"\n{'  ' * indent}}}")
+    else:
+        for i, element in enumerate(elements):
+            if i:
+                tokens.append(", ")
+            tokens.extend(element)
+        tokens.append("}")
+    stack.extend(reversed(tokens))
+
+
+def type_cache(var: lldb.SBValue) -> TypeCache:
+    process_id = var.GetProcess().GetUniqueID()
+    cache = _type_caches.get(process_id)
+    if cache is None:
+        _type_caches.clear()
+        cache = _type_caches[process_id] = TypeCache()
+    return cache
+
+
+def type_info(cache: TypeCache, var_type: lldb.SBType) -> Tuple[str, int, bool, bool, str]:
+    key = (var_type.GetName(), var_type.GetByteSize())
+    info = cache.type_infos.get(key)
+    if info is not None:
+        return info
 
-    var_type = var.GetType()
     type_class = var_type.GetTypeClass()
-    type_name = map_type_name(var_type.GetName())
+    type_name = map_type_name(key[0])
 
     # Handle typedef types
     original_type_name = type_name
@@ -145,81 +308,101 @@ def format_value(var: lldb.SBValue, debugger: lldb.SBDebugger, include_type: boo
         type_name = map_type_name(var_type.GetName())
         type_class = var_type.GetTypeClass()
 
-    if var_type.IsPointerType():
-        return format_pointer(var, debugger, indent, original_type_name)
-
-    if type_name.startswith('[]'):  # Slice
-        return format_slice(var, debugger, indent)
-    elif var_type.IsArrayType():
-        return format_array(var, debugger, indent)
-    elif type_name == 'string':  # String
-        return format_string(var)
-    elif type_class in [lldb.eTypeClassStruct, lldb.eTypeClassClass]:
-        return format_struct(var, debugger, include_type, indent, original_type_name)
-    else:
-        value = var.GetValue()
-        summary = var.GetSummary()
-        if value is not None:
-            return f"{value}" if include_type else str(value)
-        elif summary is not None:
-            return f"{summary}" if include_type else summary
-        else:
-            return "<variable not available>"
+    info = (type_name, type_class, var_type.IsPointerType(),
+            var_type.IsArrayType(), original_type_name)
+    cache.type_infos[key] = info
+    return info
 
 
-def format_slice(var: lldb.SBValue, debugger: lldb.SBDebugger, indent: int) -> str:
-    length = var.GetChildMemberWithName('len').GetValue()
+def expand_slice(var: lldb.SBValue, debugger: lldb.SBDebugger, indent: int, cache: TypeCache) -> Optional[Tuple[str, List[List[_Item]]]]:
+    length = member_as_int(var, 'len', signed=True)
     if length is None:
-        return "<variable not available>"
-    length = int(length)
+        return None
     data_ptr = var.GetChildMemberWithName('data')
-    elements: List[str] = []
 
-    ptr_value = int(data_ptr.GetValue(), 16)
+    ptr_value = data_ptr.GetValueAsUnsigned()
     element_type = data_ptr.GetType().GetPointeeType()
     element_size = element_type.GetByteSize()
 
     target = debugger.GetSelectedTarget()
-    indent_str = '  ' * indent
-    next_indent_str = '  ' * (indent + 1)
-
-    for i in range(length):
-        element_address = ptr_value + i * element_size
-        element = target.CreateValueFromAddress(
-            f"element_{i}", lldb.SBAddress(element_address, target), element_type)
-        value = format_value(
-            element, debugger, include_type=False, indent=indent+1)
-        elements.append(value)
-
-    type_name = var.GetType().GetName()
-
-    if len(elements) > 5:  # 如果元素数量大于5，则进行折行显示
-        result = f"{type_name}{{\n{next_indent_str}" + \
-            f",\n{next_indent_str}".join(elements) + f"\n{indent_str}}}"
+
+    elements: List[List[_Item]]
+    scalars = read_scalar_elements(
+        cache, var.GetProcess(), ptr_value, length, element_type)
+    if scalars is not None:
+        elements = [[value] for value in scalars]
     else:
-        result = f"{type_name}{{{', '.join(elements)}}}"
+        elements = []
+        for i in range(length):
+            element_address = ptr_value + i * element_size
+            element = target.CreateValueFromAddress(
+                f"element_{i}", lldb.SBAddress(element_address, target), element_type)
+            elements.append([(element, False, indent + 1)])
+
+    return f"{var.GetType().GetName()}{{", elements
+
+
+def scalar_format(cache: TypeCache, element_type: lldb.SBType) -> Optional[str]:
+    name = element_type.GetName()
+    if name in cache.scalar_formats:
+        return cache.scalar_formats[name]
+
+    fmt: Optional[str] = None
+    canonical = element_type.GetCanonicalType()
+    basic_type = canonical.GetBasicType()
+    if basic_type == lldb.eBasicTypeBool:
+        fmt = '?'
+    elif basic_type in _INT_BASIC_TYPES:
+        fmt = _INT_FORMATS.get(
+            (canonical.GetByteSize(), _INT_BASIC_TYPES[basic_type]))
+    cache.scalar_formats[name] = fmt
+    return fmt
+
+
+def read_scalar_elements(cache: TypeCache, process: lldb.SBProcess, address: int, length: int, element_type: lldb.SBType) -> Optional[List[str]]:
+    # Decode integer/bool elements from one memory read instead of creating
+    # an SBValue per element. Returns None if the caller must fall back.
+    if length <= 0:
+        return None
+    fmt = scalar_format(cache, element_type)
+    if fmt is None:
+        return None
 
-    return result
+    size = length * element_type.GetByteSize()
+    if size > _MAX_BULK_READ:
+        return None
 
+    _read_error.Clear()
+    data = process.ReadMemory(address, size, _read_error)
+    # A short read returns fewer bytes than requested
+    if not _read_error.Success() or data is None or len(data) != size:
+        return None
 
-def format_array(var: lldb.SBValue, debugger: lldb.SBDebugger, indent: int) -> str:
-    elements: List[str] = []
-    indent_str = '  ' * indent
-    next_indent_str = '  ' * (indent + 1)
+    order = '>' if process.GetByteOrder() == lldb.eByteOrderBig else '<'
+    values = struct.unpack(f"{order}{length}{fmt}", data)
+    if fmt == '?':
+        return ['true' if v else 'false' for v in values]
+    return [str(v) for v in values]
 
-    for i in range(var.GetNumChildren()):
-        value = format_value(var.GetChildAtIndex(
-            i), debugger, include_type=False, indent=indent+1)
-        elements.append(value)
 
+def expand_array(var: lldb.SBValue, indent: int, cache: TypeCache) -> Tuple[str, List[List[_Item]]]:
     array_size = var.GetNumChildren()
-    element_type = map_type_name(var.GetType().GetArrayElementType().GetName())
-    type_name = f"[{array_size}]{element_type}"
+    children = [var.GetChildAtIndex(i) for i in range(array_size)]
+    elements: List[List[_Item]] = [[(child, False, indent + 1)]
+                                   for child in children]
 
-    if len(elements) > 5:  # wrap line if too many elements
-        return f"{type_name}{{\n{next_indent_str}" + f",\n{next_indent_str}".join(elements) + f"\n{indent_str}}}"
-    else:
-        return f"{type_name}{{{', '.join(elements)}}}"
+    element_type = array_element_type_name(cache, var.GetType())
+    return f"[{array_size}]{element_type}{{", elements
+
+
+def array_element_type_name(cache: TypeCache, array_type: lldb.SBType) -> str:
+    name = array_type.GetName()
+    element_type = cache.elem_type_names.get(name)
+    if element_type is None:
+        element_type = map_type_name(
+            array_type.GetArrayElementType().GetName())
+        cache.elem_type_names[name] = element_type
+    return element_type
 
 
 def format_string(var: lldb.SBValue) -> str:
@@ -227,37 +410,38 @@ def format_string(var: lldb.SBValue) -> str:
     if summary is not None:
         return summary  # Keep the quotes
     else:
-        data = var.GetChildMemberWithName('data').GetValue()
-        length = var.GetChildMemberWithName('len').GetValue()
-        if data and length:
-            length = int(length)
-            error = lldb.SBError()
-            return '"%s"' % var.process.ReadCStringFromMemory(int(data, 16), length + 1, error)
+        data = member_as_int(var, 'data')
+        length = member_as_int(var, 'len', signed=True)
+        if data is not None and length is not None:
+            if length <= 0:
+                return '""'
+            if length > _MAX_STRING_LEN:
+                return "<string too long>"
+            _read_error.Clear()
+            raw = var.GetProcess().ReadMemory(data, length, _read_error)
+            if _read_error.Success() and raw is not None:
+                return '"%s"' % raw.decode('utf-8', 'replace')
     return "<variable not available>"
 
 
-def format_struct(var: lldb.SBValue, debugger: lldb.SBDebugger, include_type: bool = True, indent: int = 0, type_name: str = "") -> str:
-    children: List[str] = []
-    indent_str = '  ' * indent
-    next_indent_str = '  ' * (indent + 1)
+def member_as_int(var: lldb.SBValue, name: str, signed: bool = False) -> Optional[int]:
+    # Read an integer field without going through its string form
+    member = var.GetChildMemberWithName(name)
+    if signed:
+        value = member.GetValueAsSigned(_read_error)
+    else:
+        value = member.GetValueAsUnsigned(_read_error)
+    return value if _read_error.Success() else None
 
-    for i in range(var.GetNumChildren()):
-        child = var.GetChildAtIndex(i)
-        child_name = child.GetName()
-        child_value = format_value(
-            child, debugger, include_type=False, indent=indent+1)
-        children.append(f"{child_name} = {child_value}")
 
-    if len(children) > 5:  # 如果字段数量大于5，则进行折行显示
-        struct_content = "{\n" + ",\n".join(
-            [f"{next_indent_str}{child}" for child in children]) + f"\n{indent_str}}}"
-    else:
-        struct_content = f"{{{', '.join(children)}}}"
+def expand_struct(var: lldb.SBValue, include_type: bool, indent: int, type_name: str) -> Tuple[str, List[List[_Item]]]:
+    # Bypass synthetic child providers, which may evaluate expressions
+    var = var.GetNonSyntheticValue()
+    fields = [var.GetChildAtIndex(i) for i in range(var.GetNumChildren())]
+    elements: List[List[_Item]] = [[f"{child.GetName()} = ", (child, False, indent + 1)]
+                                   for child in fields]
 
-    if include_type:
-        return f"{type_name}{struct_content}"
-    else:
-        return struct_content
+    return (f"{type_name}{{" if include_type else "{"), elements
 
 
 def format_pointer(var: lldb.SBValue, _debugger: lldb.SBDebugger, _indent: int, _type_name: str) -> str:
@@ -266,6 +450,7 @@ def format_pointer(var: lldb.SBValue, _debugger: lldb.SBDebugger, _indent: int,
     return var.GetValue()  # Return the address as a string
 
 
+@functools.lru_cache(maxsize=None)
 def map_type_name(type_name: str) -> str:
     # Handle pointer types
     if type_name.endswith('*'):
@@ -1,39 +1,65 @@
 # pylint: disable=missing-module-docstring,missing-class-docstring,missing-function-docstring
 
 import os
+import re
 import sys
 import argparse
+import contextlib
+import importlib
+import itertools
 import signal
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass, field
-from typing import List, Optional, Set, Dict, Any
+from typing import List, Optional, Set, Tuple, FrozenSet, AbstractSet, Dict, Any, Callable, Iterator
 import lldb
 import llgo_plugin
-from llgo_plugin import log
+from llgo_plugin import log, flush
+
+_EXPECTED_HDR = re.compile(r'\s*// Expected:')
+_EXPECTED_KV = re.compile(r'\s*//+\s*([^:]*?)\s*:\s*(.*?)\s*$')
+_COMMENT = re.compile(r'\s*//')
+
+# slots=True needs Python 3.10+, LLDB may embed an older interpreter
+_DATACLASS_OPTIONS: Dict[str, Any] = {
+    'slots': True} if sys.version_info >= (3, 10) else {}
+
+# LLDB settings for running the tests, which only read values at breakpoints:
+# - formatting only reads memory, so don't let each read invalidate cached values
+# - dynamic type resolution may evaluate expressions in the target
+# - source/disassembly shown at each stop is never looked at
+_HARNESS_SETTINGS = (
+    ('target.process.track-memory-cache-changes', 'false'),
+    ('target.prefer-dynamic-value', 'no-dynamic-values'),
+    ('stop-disassembly-display', 'never'),
+    ('stop-line-count-after', '0'),
+    ('stop-line-count-before', '0'),
+)
 
 
 class LLDBTestException(Exception):
     pass
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTIONS)
 class Test:
     source_file: str
     line_number: int
     variable: str
     expected_value: str
+    expected_set: Optional[FrozenSet[str]] = None  # for "all variables"
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTIONS)
 class TestResult:
     test: Test
     status: str
     actual: Optional[str] = None
     message: Optional[str] = None
-    missing: Optional[Set[str]] = None
-    extra: Optional[Set[str]] = None
+    missing: Optional[AbstractSet[str]] = None
+    extra: Optional[AbstractSet[str]] = None
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTIONS)
 class TestCase:
     source_file: str
     start_line: int
@@ -41,14 +67,14 @@ class TestCase:
     tests: List[Test]
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTIONS)
 class CaseResult:
     test_case: TestCase
     function: str
     results: List[TestResult]
 
 
-@dataclass
+@dataclass(**_DATACLASS_OPTIONS)
 class TestResults:
     total: int = 0
     passed: int = 0
@@ -73,6 +99,9 @@ class LLDBDebugger:
         if self.plugin_path:
             self.debugger.HandleCommand(
                 f'command script import "{self.plugin_path}"')
+        # The debugger is destroyed per test case, no restore needed
+        for name, value in _HARNESS_SETTINGS:
+            self.debugger.HandleCommand(f'settings set {name} {value}')
         self.target = self.debugger.CreateTarget(self.executable_path)
         if not self.target:
             raise LLDBTestException(
@@ -90,6 +119,9 @@ class LLDBDebugger:
                 f"Failed to set breakpoint at {file_spec}: {line_number}")
         return bp
 
+    def delete_breakpoint(self, bp: lldb.SBBreakpoint) -> None:
+        self.target.BreakpointDelete(bp.GetID())
+
     def run_to_breakpoint(self) -> None:
         if not self.process:
             self.process = self.target.LaunchSimple(None, None, os.getcwd())
@@ -98,16 +130,28 @@ class LLDBDebugger:
         if self.process.GetState() != lldb.eStateStopped:
             raise LLDBTestException("Process didn't stop at breakpoint")
 
-    def get_variable_value(self, var_expression: str) -> Optional[str]:
+    def get_variable_value(self, var_expression: str, variables: Optional[Dict[str, lldb.SBValue]] = None) -> Optional[str]:
         frame = self.process.GetSelectedThread().GetFrameAtIndex(0)
-        value = llgo_plugin.evaluate_expression(frame, var_expression)
+        value = llgo_plugin.evaluate_expression(
+            frame, var_expression, variables)
         if value and value.IsValid():
             return llgo_plugin.format_value(value, self.debugger)
         return None
 
-    def get_all_variable_names(self) -> Set[str]:
+    def get_frame_variables(self, statics: bool = True) -> Tuple[Dict[str, lldb.SBValue], Set[str]]:
+        # Returns arguments and locals by name for lookups, and the names of
+        # all enumerated variables (including statics)
         frame = self.process.GetSelectedThread().GetFrameAtIndex(0)
-        return set(var.GetName() for var in frame.GetVariables(True, True, True, True))
+        variables: Dict[str, lldb.SBValue] = {}
+        names: Set[str] = set()
+        for var in frame.GetVariables(True, True, statics, True, lldb.eNoDynamicValues):
+            name = var.GetName()
+            names.add(name)
+            if var.GetValueType() in (lldb.eValueTypeVariableArgument, lldb.eValueTypeVariableLocal):
+                # Blocks are listed outermost first, let inner shadowing
+                # variables win as they do with FindVariable
+                variables[name] = var
+        return variables, names
 
     def get_current_function_name(self) -> str:
         frame = self.process.GetSelectedThread().GetFrameAtIndex(0)
@@ -123,14 +167,21 @@ class LLDBDebugger:
         log("Type 'quit' to exit and continue with the next test case.")
         log("Use Ctrl+D to exit and continue, or Ctrl+C to abort all tests.")
 
-        old_stdin, old_stdout, old_stderr = sys.stdin, sys.stdout, sys.stderr
-        sys.stdin, sys.stdout, sys.stderr = sys.__stdin__, sys.__stdout__, sys.__stderr__
+        # Line editing and history for input(), only when it is available
+        try:
+            importlib.import_module("readline")
+        except ImportError:
+            pass
 
         self.debugger.SetAsync(True)
         self.debugger.HandleCommand("settings set auto-confirm true")
+        # Interactive commands may modify memory and want stop locations shown
+        for name, _ in _HARNESS_SETTINGS:
+            self.debugger.HandleCommand(f"settings clear {name}")
         self.debugger.HandleCommand("command script import lldb")
 
         interpreter = self.debugger.GetCommandInterpreter()
+        result = lldb.SBCommandReturnObject()
         continue_tests = True
 
         def keyboard_interrupt_handler(_sig: Any, _frame: Any) -> None:
@@ -139,14 +190,10 @@ class LLDBDebugger:
             continue_tests = False
             raise KeyboardInterrupt
 
-        original_handler = signal.signal(
-            signal.SIGINT, keyboard_interrupt_handler)
-
-        try:
+        with _console_env(keyboard_interrupt_handler):
             while continue_tests:
-                log("\n(lldb) ", end="")
                 try:
-                    command = input().strip()
+                    command = input("\n(lldb) ").strip()
                 except EOFError:
                     log("\nExiting LLDB interactive mode. Continuing with next test case.")
                     break
@@ -157,44 +204,65 @@ class LLDBDebugger:
                     log("\nExiting LLDB interactive mode. Continuing with next test case.")
                     break
 
-                result = lldb.SBCommandReturnObject()
+                result.Clear()
                 interpreter.HandleCommand(command, result)
                 log(result.GetOutput().rstrip() if result.Succeeded()
                     else result.GetError().rstrip())
 
-        finally:
-            signal.signal(signal.SIGINT, original_handler)
-            sys.stdin, sys.stdout, sys.stderr = old_stdin, old_stdout, old_stderr
-
         return continue_tests
 
 
+@contextlib.contextmanager
+def _console_env(sigint_handler: Callable[[Any, Any], None]) -> Iterator[None]:
+    # Emit buffered output before switching to the real stdio
+    flush()
+    old_stdin, old_stdout, old_stderr = sys.stdin, sys.stdout, sys.stderr
+    sys.stdin, sys.stdout, sys.stderr = sys.__stdin__, sys.__stdout__, sys.__stderr__
+    original_handler = signal.signal(signal.SIGINT, sigint_handler)
+    try:
+        yield
+    finally:
+        signal.signal(signal.SIGINT, original_handler)
+        sys.stdin, sys.stdout, sys.stderr = old_stdin, old_stdout, old_stderr
+
+
 def parse_expected_values(source_files: List[str]) -> List[TestCase]:
+    # Files are independent, parse them concurrently keeping their order
+    workers = min(32, os.cpu_count() or 4, len(source_files))
+    if workers <= 1:
+        results = list(map(parse_source_file, source_files))
+    else:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            results = list(executor.map(parse_source_file, source_files))
+    return list(itertools.chain.from_iterable(results))
+
+
+def parse_source_file(source_file: str) -> List[TestCase]:
     test_cases: List[TestCase] = []
-    for source_file in source_files:
-        with open(source_file, 'r', encoding='utf-8') as f:
-            content = f.readlines()
-            i = 0
-            while i < len(content):
-                line = content[i].strip()
-                if line.startswith('// Expected:'):
-                    start_line = i + 1
-                    tests: List[Test] = []
-                    i += 1
-                    while i < len(content):
-                        line = content[i].strip()
-                        if not line.startswith('//'):
-                            break
-                        parts = line.lstrip('//').strip().split(':', 1)
-                        if len(parts) == 2:
-                            var, value = map(str.strip, parts)
-                            tests.append(Test(source_file, i + 1, var, value))
-                        i += 1
-                    end_line = i
-                    test_cases.append(
-                        TestCase(source_file, start_line, end_line, tests))
-                else:
-                    i += 1
+    with open(source_file, 'r', encoding='utf-8', buffering=1 << 16) as f:
+        tests: Optional[List[Test]] = None
+        start_line = 0
+        line_number = 0
+        for line_number, line in enumerate(f, 1):
+            if tests is None:
+                if _EXPECTED_HDR.match(line):
+                    start_line = line_number
+                    tests = []
+            elif _COMMENT.match(line):
+                m = _EXPECTED_KV.match(line)
+                if m:
+                    var, value = m.group(1), m.group(2)
+                    expected_set = frozenset(
+                        value.split()) if var == 'all variables' else None
+                    tests.append(
+                        Test(source_file, line_number, var, value, expected_set))
+            else:
+                test_cases.append(
+                    TestCase(source_file, start_line, line_number - 1, tests))
+                tests = None
+        if tests is not None:
+            test_cases.append(
+                TestCase(source_file, start_line, line_number, tests))
     return test_cases
 
 
@@ -208,27 +276,38 @@ def execute_tests(executable_path: str, test_cases: List[TestCase], verbose: boo
                 log(
                     f"\nSetting breakpoint at {test_case.source_file}:{test_case.end_line}")
             debugger.setup()
-            debugger.set_breakpoint(test_case.source_file, test_case.end_line)
+            bp = debugger.set_breakpoint(
+                test_case.source_file, test_case.end_line)
             debugger.run_to_breakpoint()
+            # Don't keep the breakpoint armed if interactive mode resumes the process
+            debugger.delete_breakpoint(bp)
 
-            all_variable_names = debugger.get_all_variable_names()
+            # Statics are only enumerated for "all variables" tests, variable
+            # lookups use the arguments and locals either way
+            needs_all = any(
+                t.variable == "all variables" for t in test_case.tests)
+            variables, names = debugger.get_frame_variables(statics=needs_all)
+            all_variable_names = names if needs_all else None
 
             case_result = execute_test_case(
-                debugger, test_case, all_variable_names)
+                debugger, test_case, all_variable_names, variables)
 
-            results.total += len(case_result.results)
-            results.passed += sum(1 for r in case_result.results if r.status == 'pass')
-            results.failed += sum(1 for r in case_result.results if r.status != 'pass')
+            total = len(case_result.results)
+            passed = sum(1 for r in case_result.results if r.status == 'pass')
+            results.total += total
+            results.passed += passed
+            results.failed += total - passed
             results.case_results.append(case_result)
 
             case = case_result.test_case
             loc = f"{case.source_file}:{case.start_line}-{case.end_line}"
-            if verbose or interactive or any(r.status != 'pass' for r in case_result.results):
+            if verbose or interactive or passed != total:
                 log(f"\nTest case: {loc} in function '{case_result.function}'")
             for result in case_result.results:
                 print_test_result(result, verbose=verbose)
+            flush()
 
-            if interactive and any(r.status != 'pass' for r in case_result.results):
+            if interactive and passed != total:
                 log("\nTest case failed. Entering LLDB interactive mode.")
                 continue_tests = debugger.run_console()
                 if not continue_tests:
@@ -255,21 +334,28 @@ def run_tests(executable_path: str, source_files: List[str], verbose: bool, inte
     return 0 if results.failed == 0 else 1
 
 
-def execute_test_case(debugger: LLDBDebugger, test_case: TestCase, all_variable_names: Set[str]) -> CaseResult:
+def execute_test_case(debugger: LLDBDebugger, test_case: TestCase, all_variable_names: Optional[Set[str]], variables: Optional[Dict[str, lldb.SBValue]] = None) -> CaseResult:
     results: List[TestResult] = []
 
     for test in test_case.tests:
         if test.variable == "all variables":
             result = execute_all_variables_test(test, all_variable_names)
         else:
-            result = execute_single_variable_test(debugger, test)
+            result = execute_single_variable_test(debugger, test, variables)
         results.append(result)
 
     return CaseResult(test_case, debugger.get_current_function_name(), results)
 
 
-def execute_all_variables_test(test: Test, all_variable_names: Set[str]) -> TestResult:
-    expected_vars = set(test.expected_value.split())
+def execute_all_variables_test(test: Test, all_variable_names: Optional[Set[str]]) -> TestResult:
+    if all_variable_names is None:
+        return TestResult(
+            test=test,
+            status='error',
+            actual=set(),
+            message='Variables of the frame were not collected'
+        )
+    expected_vars = test.expected_set
     if expected_vars == all_variable_names:
         return TestResult(
             test=test,
@@ -286,8 +372,8 @@ def execute_all_variables_test(test: Test, all_variable_names: Set[str]) -> Test
         )
 
 
-def execute_single_variable_test(debugger: LLDBDebugger, test: Test) -> TestResult:
-    actual_value = debugger.get_variable_value(test.variable)
+def execute_single_variable_test(debugger: LLDBDebugger, test: Test, variables: Optional[Dict[str, lldb.SBValue]] = None) -> TestResult:
+    actual_value = debugger.get_variable_value(test.variable, variables)
     if actual_value is None:
         return TestResult(
             test=test,
@@ -321,6 +407,7 @@ def print_test_results(results: TestResults) -> None:
         log("All tests passed!")
     else:
         log("Some tests failed")
+    flush()
 
 
 def print_test_result(result: TestResult, verbose: bool) -> None:
@@ -336,11 +423,13 @@ def print_test_result(result: TestResult, verbose: bool) -> None:
     else:  # fail or error
         log(f"{status_symbol} Line {test.line_number}, {test.variable}: {status_text}")
         if test.variable == 'all variables':
+            if result.message:
+                log(f"    Error: {result.message}")
             if result.missing:
                 log(f"    Missing variables: {', '.join(sorted(result.missing))}")
             if result.extra:
                 log(f"    Extra variables: {', '.join(sorted(result.extra))}")
-            log(f"    Expected: {', '.join(sorted(test.expected_value.split()))}")
+            log(f"    Expected: {', '.join(sorted(test.expected_set))}")
             log(f"    Actual: {', '.join(sorted(result.actual))}")
         elif result.status == 'error':
             log(f"    Error: {result.message}")
@@ -351,18 +440,21 @@ def print_test_result(result: TestResult, verbose: bool) -> None:
 
 def run_tests_with_result(executable_path: str, source_files: List[str], verbose: bool, interactive: bool, plugin_path: Optional[str], result_path: str) -> int:
     try:
-        exit_code = run_tests(executable_path, source_files,
-                              verbose, interactive, plugin_path)
-    except Exception as e:
-        log(f"An error occurred during test execution: {str(e)}")
-        exit_code = 2  # Use a different exit code for unexpected errors
+        try:
+            exit_code = run_tests(executable_path, source_files,
+                                  verbose, interactive, plugin_path)
+        except Exception as e:
+            log(f"An error occurred during test execution: {str(e)}")
+            exit_code = 2  # Use a different exit code for unexpected errors
 
-    try:
-        with open(result_path, 'w', encoding='utf-8') as f:
-            f.write(str(exit_code))
-    except IOError as e:
-        log(f"Error writing result to file {result_path}: {str(e)}")
-        # If we can't write to the file, we should still return the exit code
+        try:
+            with open(result_path, 'w', encoding='utf-8') as f:
+                f.write(str(exit_code))
+        except IOError as e:
+            log(f"Error writing result to file {result_path}: {str(e)}")
+            # If we can't write to the file, we should still return the exit code
+    finally:
+        flush()
 
     return exit_code
 
@@ -394,6 +486,8 @@ def main() -> None:
     except Exception as e:
         log(f"An unexpected error occurred: {str(e)}")
         exit_code = 2  # Use a different exit code for unexpected errors
+    finally:
+        flush()
 
     sys.exit(exit_code)
 